@@ -0,0 +1 @@
+__version__ = '0.8.14'
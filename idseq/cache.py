@@ -0,0 +1,36 @@
+"""Module for reading and writing local state files in ~/.idseq."""
+
+import io
+import json
+import os
+
+CACHE_DIR = os.environ.get("IDSEQ_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".idseq"))
+
+
+def cache_path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def load_json(path, default=None):
+    """Load a JSON state file, returning default if it is missing or unreadable."""
+    try:
+        with io.open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """Write a JSON state file atomically so a crash never leaves it half written."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, sort_keys=True)
+    try:
+        os.replace(tmp_path, path)
+    except AttributeError:  # Python 2
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
@@ -1,10 +1,16 @@
 from __future__ import print_function
 import argparse
 import re
-import requests
 import traceback
 import sys
+from . import cache
+from . import locations
+from . import profiling
+from . import s3
+from . import shard
 from . import uploader
+from . import watch
+from .upload_index import UploadIndex
 
 from builtins import input
 from future.utils import viewitems
@@ -22,6 +28,7 @@ def validate_file(path, name):
 
 
 def main():
+    sys.tracebacklimit = 0
     message = "Warning: this CLI will soon be deprecated," + \
               " consider switching to version 2: https://github.com/chanzuckerberg/idseq-cli-v2\n"
     print(message, file=sys.stderr)
@@ -36,6 +43,11 @@ def main():
         metavar='name',
         type=str,
         help='Project name. Make sure the project is created on the website ')
+    parser.add_argument(
+        '--project-id',
+        metavar='id',
+        type=int,
+        help='Project id. Use instead of --project to skip looking up the project by name')
     parser.add_argument(
         '-s',
         '--sample-name',
@@ -89,11 +101,77 @@ def main():
         type=int,
         default=uploader.DEFAULT_MAX_PART_SIZE_IN_MB,
         help='Break up uploaded files into chunks of this size in MB')
+    parser.add_argument(
+        '--s3-endpoint-url',
+        metavar='url',
+        type=str,
+        help='Use this S3 endpoint for s3:// sources instead of AWS (e.g. a local S3 emulator)')
+    parser.add_argument(
+        '--reupload',
+        action='store_true',
+        help='In bulk mode, also upload samples that were already uploaded to the project')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='With --bulk and --metadata, keep watching the folder while a sequencing run is being '
+             'written and upload each sample as soon as its files are complete')
+    parser.add_argument(
+        '--watch-interval',
+        metavar='seconds',
+        type=int,
+        default=watch.POLL_INTERVAL,
+        help='How often to check the watched folder for changes')
+    parser.add_argument(
+        '--shard',
+        metavar='i/N',
+        type=shard.parse_shard,
+        help='In bulk mode, only upload the samples in shard i of N (0 <= i < N). Run one shard per host '
+             'to split a bulk upload across N hosts')
+    parser.add_argument(
+        '--claim-dir',
+        metavar='dir',
+        type=str,
+        help='Shared folder for claim files. Hosts running the same bulk upload with the same claim '
+             'folder each take the next sample no other host has claimed yet')
+    parser.add_argument(
+        '--claim-ttl',
+        metavar='hours',
+        type=float,
+        default=shard.CLAIM_TTL_HOURS,
+        help='Take over claims older than this, e.g. left behind by a host that crashed')
+    parser.add_argument(
+        '--report',
+        metavar='file',
+        type=str,
+        help='Write a JSON report of the samples uploaded by this host')
+    parser.add_argument(
+        '--merge-reports',
+        metavar='file',
+        type=str,
+        nargs='+',
+        help='Combine reports from several hosts, print a summary (and write it to --report), then exit')
+    parser.add_argument(
+        '--profile',
+        metavar='dir',
+        type=str,
+        help='Profile each upload phase (detection, metadata, geosearch, registration, split, transfer, '
+             'finalize) and write cProfile stats and a time/memory summary to this folder')
     parser.add_argument(
         '--accept-all',
         action='store_true',
         help='Use this argument to automatically accept confirmation messages')
     args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+    if args.watch and (not args.bulk or not args.metadata or s3.is_s3_path(args.bulk)):
+        parser.error("--watch requires a local --bulk folder and a --metadata file")
+
+    if args.merge_reports:
+        report = shard.merge_reports(args.merge_reports)
+        shard.print_report_summary(report)
+        if args.report:
+            cache.save_json(args.report, report)
+        return
 
     print("Instructions: https://idseq.net/cli_user_instructions\nStarting "
           "IDseq command line...")
@@ -105,13 +183,13 @@ def main():
         args.token = required_input("\nEnter your IDseq authentication token:\n("
                                     "see instructions at "
                                     "http://idseq.net/cli_user_instructions): ")
-    if not args.project:
+    if not args.project and not args.project_id:
         args.project = required_input("\nEnter the project name: ")
     if not args.bulk:
         if not args.sample_name:
             inp = input("{:35}".format("\nEnter the sample name (or press Enter to "
                         "use bulk mode): "))
-            if inp is '':
+            if inp == '':
                 args.bulk = "."  # Run bulk auto-detect on the current folder
             else:
                 args.sample_name = inp
@@ -134,13 +212,49 @@ def main():
         "X-User-Token": args.token,
     }
 
-    args.project, args.project_id = uploader.validate_project(args.url, headers, args.project)
+    if args.project_id:
+        args.project, args.project_id = uploader.validate_project_id(args.url, headers, args.project_id)
+    else:
+        args.project, args.project_id = uploader.validate_project(args.url, headers, args.project)
 
     print("\n{:20}{}".format("PROJECT:", args.project))
+    index = UploadIndex()
+    report = shard.Report(args.report) if args.report else None
+
+    # Upload samples from a run folder that is still being written
+    if args.watch:
+        if not args.accept_all:
+            uploader.get_user_agreement()
+        processing = {}
+        try:
+            watch.watch(
+                args.bulk,
+                lambda samples2files: upload_watched_samples(samples2files, headers, args, index, report, processing),
+                watch.state_path(args.bulk, args.url, args.project_id),
+                poll_interval=args.watch_interval,
+                # Poll once per check while the run is going, then wait for the rest at the end
+                check_uploads=lambda final: wait_for_uploaded_samples(
+                    processing, headers, args, index, report, uploader.STATUS_POLL_TIMEOUT if final else 0))
+        except KeyboardInterrupt:
+            print("\nStopped watching. Run the same command again to resume.")
+        return
 
     # Bulk upload
     if args.bulk:
-        samples2files = uploader.detect_samples(args.bulk)
+        with profiling.phase("detection"):
+            samples2files = uploader.detect_samples(args.bulk, args.s3_endpoint_url)
+            # Shard first so each host only checks its own samples
+            if args.shard:
+                samples2files = select_shard(samples2files, args.shard)
+
+            invalid_files = s3.validate_s3_files(
+                [f for files in samples2files.values() for f in files], args.s3_endpoint_url)
+            for sample, files in list(viewitems(samples2files)):
+                if invalid_files.intersection(files):
+                    print("Skipping sample \"{}\": S3 file(s) missing, empty or unreadable".format(sample))
+                    del samples2files[sample]
+            if not args.reupload:
+                skip_uploaded_samples(samples2files, index, headers, args)
 
         if len(samples2files) == 0:
             print("No proper single or paired samples detected")
@@ -153,10 +267,10 @@ def main():
             args.url, headers, list(samples2files.keys()), args.project_id, args.metadata)
         if not args.accept_all:
             uploader.get_user_agreement()
+        results = {}
         for sample, files in viewitems(samples2files):
-            if len(files) < 2:
-                files.append(None)
-            upload_sample(sample, files[0], files[1], headers, args, csv_metadata[sample])
+            results[sample] = upload_bulk_sample(sample, files, headers, args, csv_metadata[sample], index, report)
+        wait_for_uploaded_samples(processing_samples(results, samples2files), headers, args, index, report)
         return
 
     # Single upload
@@ -165,26 +279,178 @@ def main():
     if args.r2:
         validate_file(args.r2, 'R2')
         input_files.append(args.r2)
+    with profiling.phase("detection"):
+        invalid_files = s3.validate_s3_files(input_files, args.s3_endpoint_url)
+    if invalid_files:
+        raise ValueError("S3 file(s) missing, empty or unreadable")
     print_sample_files_info(args.sample_name, input_files)
     csv_metadata = uploader.get_user_metadata(args.url, headers, [args.sample_name], args.project_id, args.metadata)
     if not args.accept_all:
         uploader.get_user_agreement()
-    upload_sample(args.sample_name, args.r1, args.r2, headers, args, csv_metadata[args.sample_name])
+    upload_sample(args.sample_name, args.r1, args.r2, headers, args, csv_metadata[args.sample_name], index)
 
 
 def required_input(msg):
     resp = input(msg.ljust(35))
-    if resp is '':
+    if resp == '':
         raise RuntimeError("Value required!")
     return resp
 
 
-def upload_sample(sample_name, file_0, file_1, headers, args, csv_metadata):
+def skip_uploaded_samples(samples2files, index, headers, args):
+    # Like rsync: only upload samples that are new to the project or whose files changed
+    existing = uploader.get_project_samples(args.url, headers, args.project_id)
+    if existing is None:
+        print("Could not list existing samples in the project. Using the local upload index only.")
+    incomplete = []
+    for sample, files in list(viewitems(samples2files)):
+        entry = index.lookup(args.url, args.project_id, files)
+        if existing is None:
+            if not entry:
+                continue
+            reason = "already uploaded"
+        elif sample in existing:
+            status = existing[sample][1]
+            if status != "uploaded":
+                # Registered, but the transfer or processing failed or never finished
+                incomplete.append(sample)
+                reason = "a sample with this name exists in the project but its upload is {}".format(
+                    "failed" if status == "failed" else "not finished")
+            elif entry:
+                reason = "already uploaded"
+            elif index.lookup_sample_name(args.url, args.project_id, sample):
+                reason = "files changed since it was uploaded. Use a new sample name to upload them again"
+            else:
+                reason = "a sample with this name already exists in the project"
+        else:
+            continue
+        print("Skipping sample \"{}\": {}".format(sample, reason))
+        del samples2files[sample]
+    if incomplete:
+        print("\nThese samples were not completely uploaded. Unless another upload is still running, "
+              "delete them on IDseq {} and run the command again to upload them:".format(args.url))
+        for sample in sorted(incomplete):
+            print("  {}".format(sample))
+
+
+def select_shard(samples2files, shard_spec):
+    selected = dict((s, f) for s, f in viewitems(samples2files) if shard.in_shard(s, shard_spec))
+    print("Shard {}/{}: {} of {} samples".format(shard_spec[0], shard_spec[1], len(selected), len(samples2files)))
+    return selected
+
+
+def upload_watched_samples(samples2files, headers, args, index, report, processing):
+    # Returns {sample: sample id, or None if it failed or was skipped} for the samples that were tried.
+    # Samples left out are offered again on the next check. Uploaded samples are added to processing
+    # so their status can be polled while later samples are transferred.
+    import requests
+
+    ready = list(samples2files)
+    samples2files = dict(samples2files)
+    if args.shard:
+        samples2files = select_shard(samples2files, args.shard)
+    if not args.reupload:
+        skip_uploaded_samples(samples2files, index, headers, args)
+    skipped = dict((sample, None) for sample in ready if sample not in samples2files)
+    if not samples2files:
+        return skipped
+
+    print("\nNew samples ready to upload:")
+    for sample, files in viewitems(samples2files):
+        print_sample_files_info(sample, files)
+    # The metadata file is re-read for every batch so it can be filled in while the run is going
+    try:
+        issues = uploader.validate_metadata(args.url, headers, list(samples2files), args.project_id, args.metadata)
+    except (OSError, ValueError, requests.exceptions.RequestException) as err:
+        print("\nCould not validate metadata: {}. Will try again on the next check.".format(err))
+        return skipped
+    if uploader.display_metadata_errors(issues):
+        print("\nThese samples will be uploaded once the metadata errors are fixed.")
+        return skipped
+    csv_metadata = locations.match_csv_locations(args.url, headers, uploader.load_metadata(args.metadata))
+
+    results = skipped
+    for sample, files in viewitems(samples2files):
+        results[sample] = upload_bulk_sample(sample, files, headers, args, csv_metadata.get(sample, {}), index, report)
+    processing.update(processing_samples(results, samples2files))
+    return results
+
+
+def processing_samples(results, samples2files):
+    # {sample id: (sample, files)} for the local samples the server may still be processing
+    return dict(
+        (sample_id, (sample, samples2files[sample])) for sample, sample_id in viewitems(results)
+        if sample_id and not s3.is_s3_path(samples2files[sample][0])
+    )
+
+
+def wait_for_uploaded_samples(processing, headers, args, index, report, timeout=uploader.STATUS_POLL_TIMEOUT):
+    # Samples are transferred without waiting for the server to process each one, so poll for the
+    # final status of all of them together; timeout=0 polls once. Samples that finished are removed
+    # from processing. Returns the names of samples that failed.
+    if not processing:
+        return []
+    statuses = uploader.wait_for_samples(
+        args.url, headers, args.project_id, list(processing), verbose=timeout > 0, timeout=timeout)
+
+    lines = []
+    failed = []
+    for sample_id, (status, error) in viewitems(statuses):
+        sample, files = processing[sample_id]
+        if status == "processing":
+            if timeout > 0:
+                lines.append("{:30} | Still processing. Check for status on IDseq {}".format(sample, args.url))
+            continue
+        del processing[sample_id]
+        if status == "uploaded":
+            lines.append("{:30} | Uploaded".format(sample))
+        else:
+            lines.append("{:30} | Failed: {}".format(sample, error))
+            failed.append(sample)
+            forget_failed_sample(sample, sample_id, files, args, index, report)
+    if lines:
+        print("\n{:30} | Status".format("Sample Name"))
+        print("-" * 60)
+        print("\n".join(lines))
+    return failed
+
+
+def forget_failed_sample(sample_name, sample_id, files, args, index, report):
+    # Let another host or a later run try the sample again
+    index.remove(args.url, args.project_id, sample_id)
+    if args.claim_dir:
+        shard.release(args.claim_dir, args.url, args.project_id, sample_name)
+    if report:
+        report.add(sample_name, files, None)
+
+
+def upload_bulk_sample(sample_name, files, headers, args, csv_metadata, index, report):
+    # With --claim-dir, hosts sharing the same input skip samples another host has taken
+    if args.claim_dir and not shard.claim(args.claim_dir, args.url, args.project_id, sample_name, args.claim_ttl):
+        print("\nSkipping sample \"{}\": claimed by another host".format(sample_name))
+        return None
+    files = list(files) + [None]
+    sample_id = upload_sample(sample_name, files[0], files[1], headers, args, csv_metadata, index, wait=False)
+    if args.claim_dir and not sample_id:
+        shard.release(args.claim_dir, args.url, args.project_id, sample_name)
+    if report:
+        report.add(sample_name, files, sample_id)
+    return sample_id
+
+
+def upload_sample(sample_name, file_0, file_1, headers, args, csv_metadata, index=None, wait=True):
+    import requests
+
     try:
-        uploader.upload(
+        sample_id = uploader.upload(
             sample_name, args.project_id, headers, args.url, file_0, file_1,
-            args.uploadchunksize, csv_metadata
+            args.uploadchunksize, csv_metadata, wait=wait
         )
+        if sample_id and index:
+            index.record(args.url, args.project_id, sample_name, sample_id, [f for f in [file_0, file_1] if f])
+        return sample_id
+    except uploader.UploadError as e:
+        sample_error_text(sample_name, e)
     except requests.exceptions.RequestException as e:
         sample_error_text(sample_name, e)
         network_err_text()
@@ -0,0 +1,173 @@
+"""Library API for uploading samples to IDseq from Python.
+
+Example:
+
+    from idseq.client import Client
+
+    client = Client("me@example.com", "my-token")
+    project_name, project_id = client.get_project("My Project")
+    samples = client.detect_samples("/path/to/run")
+    metadata = client.get_metadata("/path/to/metadata.csv", samples.keys(), project_id)
+    for result in client.upload_samples(project_id, samples, metadata):
+        print(result.sample_name, result.sample_id, result.error)
+
+Unlike the command line, nothing here prompts for input or prints progress unless verbose=True.
+"""
+
+import copy
+import threading
+
+from . import locations
+from . import s3
+from . import uploader
+
+DEFAULT_URL = "https://idseq.net"
+DEFAULT_MAX_WORKERS = 4
+
+
+class UploadResult():
+    """Outcome of uploading one sample. error is None on success."""
+
+    def __init__(self, sample_name, sample_id=None, error=None):
+        self.sample_name = sample_name
+        self.sample_id = sample_id
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "UploadResult({!r}, sample_id={!r}, error={!r})".format(self.sample_name, self.sample_id, self.error)
+
+
+class Client():
+    """Holds the session, credentials and upload settings for talking to IDseq.
+
+    A single Client can be shared by many uploads; HTTP connections are pooled across them.
+    """
+
+    def __init__(self, email, token, url=DEFAULT_URL, chunk_size=uploader.DEFAULT_MAX_PART_SIZE_IN_MB,
+                 max_workers=DEFAULT_MAX_WORKERS, verbose=False):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self.headers = {
+            "Accept": "application/json",
+            "Content-type": "application/json",
+            "X-User-Email": email,
+            "X-User-Token": token,
+        }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_project(self, project_name, create=False):
+        """Return the (name, id) of a project, optionally creating it. Raises ValueError if it doesn't exist."""
+        names_to_ids = uploader.list_projects(self.url, self.headers, self.session)
+        if project_name not in names_to_ids:
+            names_to_ids = uploader.list_projects(self.url, self.headers, self.session, max_age=0)
+        if project_name in names_to_ids:
+            return project_name, names_to_ids[project_name]
+        if create:
+            return uploader.create_project(self.url, self.headers, project_name, self.session)
+        raise ValueError("Project does not exist: {}".format(project_name))
+
+    def get_project_by_id(self, project_id):
+        """Return the (name, id) of a project. Raises requests.HTTPError if it doesn't exist."""
+        return uploader.get_project(self.url, self.headers, project_id, self.session)
+
+    def detect_samples(self, path, endpoint_url=None):
+        """Return {sample name: [R1 path, (R2 path)]} for the fastq/fasta files in a folder or S3 prefix.
+
+        Raises ValueError if no fastq/fasta files are found.
+        """
+        return uploader.detect_samples(path, endpoint_url, verbose=self.verbose)
+
+    def validate_metadata(self, metadata_file, sample_names, project_id):
+        """Validate a metadata CSV for the given samples. Returns {"errors": [...], "warnings": [...]}."""
+        return uploader.validate_metadata(
+            self.url, self.headers, list(sample_names), project_id, metadata_file, self.session)
+
+    def get_metadata(self, metadata_file, sample_names, project_id, geosearch=True):
+        """Validate a metadata CSV and return it as {sample name: {field: value}}. Raises ValueError on errors.
+
+        With geosearch=True, collection locations are matched to known locations without confirmation.
+        """
+        issues = self.validate_metadata(metadata_file, sample_names, project_id)
+        if issues.get("errors"):
+            raise ValueError("Metadata errors: {}".format(issues["errors"]))
+        csv_data = uploader.load_metadata(metadata_file)
+        if geosearch:
+            locations.match_csv_locations(self.url, self.headers, csv_data, self.session, self.verbose)
+        return csv_data
+
+    def upload_sample(self, project_id, sample_name, r1, r2=None, metadata=None, wait=True):
+        """Upload one sample. Returns an UploadResult instead of raising.
+
+        With wait=False, return once the files are transferred, without waiting for IDseq to process them.
+        """
+        try:
+            sample_id = uploader.upload(
+                sample_name, project_id, self.headers, self.url, r1, r2, self.chunk_size,
+                copy.deepcopy(metadata or {}), session=self.session, verbose=self.verbose, wait=wait)
+            return UploadResult(sample_name, sample_id)
+        except Exception as err:
+            return UploadResult(sample_name, error=str(err) or type(err).__name__)
+
+    def upload_samples(self, project_id, samples, metadata, max_workers=None):
+        """Upload many samples concurrently.
+
+        samples is {sample name: [R1 path, (R2 path)]} as returned by detect_samples, and metadata is
+        {sample name: {field: value}} as returned by get_metadata. Returns one UploadResult per sample,
+        in the order of samples.
+
+        Workers move on to the next sample as soon as the files are transferred. Once everything is
+        transferred, all samples are polled together until IDseq has processed them.
+        """
+        names = list(samples)
+        pending = iter(names)
+        lock = threading.Lock()
+        results = {}
+
+        def worker():
+            while True:
+                with lock:
+                    name = next(pending, None)
+                if name is None:
+                    return
+                files = list(samples[name]) + [None]
+                results[name] = self.upload_sample(
+                    project_id, name, files[0], files[1], metadata.get(name), wait=False)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(max_workers or self.max_workers, len(names)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        uploaded = dict(
+            (result.sample_id, name) for name, result in results.items()
+            if result.success and not s3.is_s3_path(samples[name][0])
+        )
+        if uploaded:
+            statuses = uploader.wait_for_samples(
+                self.url, self.headers, project_id, list(uploaded), self.session, self.verbose)
+            for sample_id, (status, error) in statuses.items():
+                if status == "failed":
+                    results[uploaded[sample_id]].error = "IDseq could not process the uploaded files: {}".format(error)
+        return [results[name] for name in names]
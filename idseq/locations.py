@@ -1,7 +1,6 @@
 """Module for handling location metadata and geosearching."""
 
 import random
-import requests
 import threading
 import time
 
@@ -9,6 +8,7 @@ import time
 from builtins import input
 
 from . import constants
+from . import profiling
 
 MAX_GEOSEARCH_ATTEMPTS = 3
 MAX_GEOSEARCH_THREADS = 5
@@ -32,6 +32,16 @@ def geosearch_and_set_csv_locations(base_url, headers, csv_data, project_id):
     return csv_data
 
 
+def match_csv_locations(base_url, headers, csv_data, session=None, verbose=True):
+    """Geosearch CSV collection locations and accept all matches without confirmation.
+
+    With verbose=False, locations that can't be searched are kept as plain text without printing.
+    """
+    matched_locations = fetch_location_matches(get_raw_locations(csv_data), base_url, headers, session, verbose)
+    set_location_matches(csv_data, matched_locations)
+    return csv_data
+
+
 def get_raw_locations(csv_data):
     raw_names = set()
     for metadata in csv_data.values():
@@ -41,23 +51,29 @@ def get_raw_locations(csv_data):
     return raw_names
 
 
-def fetch_location_matches(raw_names, base_url, headers):
-    matched_locations = {}
-    semaphore = threading.Semaphore(MAX_GEOSEARCH_THREADS)
-    threads = []
-    for query in raw_names:
-        with semaphore:
-            t = threading.Thread(
-                target=get_geo_search_suggestion,
-                args=[base_url, headers, query, matched_locations],
-            )
-            t.start()
-            threads.append(t)
-    for t in threads:
-        t.join()
+def fetch_location_matches(raw_names, base_url, headers, session=None, verbose=True):
+    with profiling.phase("geosearch"):
+        matched_locations = {}
+        semaphore = threading.Semaphore(MAX_GEOSEARCH_THREADS)
+        threads = []
+        for query in raw_names:
+            with semaphore:
+                t = threading.Thread(
+                    target=geo_search_worker,
+                    args=[base_url, headers, query, matched_locations, session, verbose],
+                )
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
     return matched_locations
 
 
+def geo_search_worker(base_url, headers, query, matched_locations, session=None, verbose=True):
+    with profiling.phase("geosearch"):
+        get_geo_search_suggestion(base_url, headers, query, matched_locations, session=session, verbose=verbose)
+
+
 def confirm_location_matches(matched_locations):
     print("\nConfirm Your Collection Locations")
     print(
@@ -116,10 +132,13 @@ def print_location_matches(csv_data, base_url, project_id):
     )
 
 
-def get_geo_search_suggestion(base_url, headers, query, matched_locations, attempt=0):
+def get_geo_search_suggestion(base_url, headers, query, matched_locations, attempt=0, session=None, verbose=True):
     """Get a geosearch location suggestion from the server."""
+    import requests
+
+    http = session or requests
     url = "{}/locations/external_search?query={}&limit=1".format(base_url, query)
-    resp = requests.get(url, headers=headers)
+    resp = http.get(url, headers=headers)
 
     if resp.status_code == 200:
         resp = resp.json()
@@ -129,9 +148,9 @@ def get_geo_search_suggestion(base_url, headers, query, matched_locations, attem
         # Wait 1-2 seconds
         time.sleep(1 + random.random())
         get_geo_search_suggestion(
-            base_url, headers, query, matched_locations, attempt + 1
+            base_url, headers, query, matched_locations, attempt + 1, session, verbose
         )
-    else:
+    elif verbose:
         print(
             "\nError finding location match for: '{}'. Location will be saved as plain text "
             "and not appear on IDseq maps.\n".format(query)
@@ -0,0 +1,154 @@
+"""Module for measuring where an upload spends its time and memory (--profile).
+
+Code marks its phases with `with profiling.phase("transfer"):`, which does nothing unless
+profiling was enabled. When enabled, each phase gets wall and CPU timers, a cProfile profile
+and (on Python 3) its tracemalloc peak. Results are written to the output folder on exit:
+one <phase>.pstats file per phase plus summary.json, and a summary table is printed.
+
+Phases can nest (e.g. geosearch inside metadata). Timers and peak memory include nested
+phases, while each .pstats file only has the calls made outside nested phases. Timers and
+memory are measured on the thread that enabled profiling. Before Python 3.12, a phase entered on
+a worker thread (e.g. each geosearch request) gets its own profile, merged into the phase's
+.pstats file. From 3.12, cProfile sees every thread, so worker calls are recorded in the profile
+of whichever phase the main thread is in.
+"""
+
+from __future__ import print_function
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    cpu_time = time.process_time
+except AttributeError:  # Python 2
+    cpu_time = time.clock
+
+profiler = None
+
+
+class Profiler():
+    def __init__(self, output_dir):
+        import cProfile
+
+        self.output_dir = output_dir
+        self.thread = threading.current_thread()
+        self.stats = {}  # phase -> {"calls", "wall_seconds", "cpu_seconds", "peak_memory_bytes"}
+        self.profiles = {}  # phase -> cProfile.Profile
+        self.stack = []  # Frames of the phases currently running, innermost last
+        self.thread_profiles = {}  # phase -> [cProfile.Profile] from worker threads
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.new_profile = cProfile.Profile
+        try:
+            import tracemalloc
+            tracemalloc.start()
+            self.tracemalloc = tracemalloc
+        except ImportError:
+            self.tracemalloc = None
+
+    def traced_peak(self):
+        return self.tracemalloc.get_traced_memory()[1] if self.tracemalloc else 0
+
+    def enter(self, name):
+        if self.stack:
+            # Only one profile can be active at a time, so pause the enclosing phase's
+            parent = self.stack[-1]
+            self.profiles[parent["name"]].disable()
+            parent["peak"] = max(parent["peak"], self.traced_peak())
+        if self.tracemalloc:
+            current = self.tracemalloc.get_traced_memory()[0]
+            if hasattr(self.tracemalloc, "reset_peak"):
+                self.tracemalloc.reset_peak()
+        else:
+            current = 0
+        self.stack.append({"name": name, "wall": time.time(), "cpu": cpu_time(), "memory": current, "peak": 0})
+        self.profiles.setdefault(name, self.new_profile()).enable()
+
+    def exit(self):
+        frame = self.stack.pop()
+        name = frame["name"]
+        self.profiles[name].disable()
+        peak = max(frame["peak"], self.traced_peak())
+        stats = self.stats.setdefault(
+            name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_memory_bytes": 0})
+        stats["calls"] += 1
+        stats["wall_seconds"] += time.time() - frame["wall"]
+        stats["cpu_seconds"] += cpu_time() - frame["cpu"]
+        stats["peak_memory_bytes"] = max(stats["peak_memory_bytes"], peak - frame["memory"])
+        if self.stack:
+            parent = self.stack[-1]
+            parent["peak"] = max(parent["peak"], peak)
+            self.profiles[parent["name"]].enable()
+
+    @contextlib.contextmanager
+    def worker_phase(self, name):
+        # Before Python 3.12, cProfile only sees the thread that enabled it, so each worker thread gets
+        # its own profile. Phases nested inside it on the same thread are part of it. From 3.12 only
+        # one profile can be active in the whole process, and it already sees this thread.
+        if sys.version_info >= (3, 12) or getattr(self.local, "active", False):
+            yield
+            return
+        profile = self.new_profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active; profiling must never break the upload
+            yield
+            return
+        self.local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.active = False
+            with self.lock:
+                self.thread_profiles.setdefault(name, []).append(profile)
+
+    def dump(self):
+        import pstats
+
+        while self.stack:  # Phases interrupted by an exception or exit
+            self.exit()
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        for name in set(self.profiles) | set(self.thread_profiles):
+            profiles = [self.profiles[name]] if name in self.profiles else []
+            stats = pstats.Stats(*(profiles + self.thread_profiles.get(name, [])))
+            stats.dump_stats(os.path.join(self.output_dir, "{}.pstats".format(name)))
+        with open(os.path.join(self.output_dir, "summary.json"), "w") as f:
+            json.dump(self.stats, f, indent=2, sort_keys=True)
+
+        print("\n{:15} | {:>5} | {:>10} | {:>10} | {:>12}".format(
+            "Phase", "Calls", "Wall (s)", "CPU (s)", "Peak mem (MB)"))
+        print("-" * 65)
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1]["wall_seconds"]):
+            print("{:15} | {:>5} | {:>10.2f} | {:>10.2f} | {:>12.1f}".format(
+                name, stats["calls"], stats["wall_seconds"], stats["cpu_seconds"], stats["peak_memory_bytes"] / 1E6))
+        print("Profiles written to {} (view with: python -m pstats {})".format(
+            self.output_dir, os.path.join(self.output_dir, "<phase>.pstats")))
+
+
+def enable(output_dir):
+    """Start profiling phases; results are written to output_dir when the process exits."""
+    global profiler
+    profiler = Profiler(output_dir)
+    atexit.register(profiler.dump)
+
+
+@contextlib.contextmanager
+def phase(name):
+    if profiler is None:
+        yield
+        return
+    if threading.current_thread() is not profiler.thread:
+        with profiler.worker_phase(name):
+            yield
+        return
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.exit()
@@ -0,0 +1,84 @@
+"""Module for checking S3 sample sources before they are registered."""
+
+import json
+import threading
+
+MAX_HEAD_OBJECT_THREADS = 10
+
+
+def is_s3_path(path):
+    return path is not None and path.startswith("s3://")
+
+
+def split_path(s3_path):
+    bucket, _, key = s3_path[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def aws_command(args, endpoint_url=None):
+    """Build an AWS CLI command, optionally pointed at another endpoint (e.g. a local S3 emulator)."""
+    command = ["aws"]
+    if endpoint_url:
+        command += ["--endpoint-url", endpoint_url]
+    return command + args
+
+
+def head_object(s3_path, endpoint_url=None):
+    """Return the size and ETag of an S3 object. Raises ValueError if it is missing or unreadable."""
+    import subprocess
+
+    bucket, key = split_path(s3_path)
+    if not bucket or not key:
+        raise ValueError("Not a valid S3 object path")
+    proc = subprocess.Popen(
+        aws_command(["s3api", "head-object", "--bucket", bucket, "--key", key], endpoint_url),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(err.decode("UTF-8").strip() or "Could not read object")
+    resp = json.loads(out.decode("UTF-8"))
+    return {"size": resp["ContentLength"], "etag": resp.get("ETag", "").strip('"')}
+
+
+def head_objects(s3_paths, endpoint_url=None):
+    """HEAD all the given objects concurrently. Returns ({path: object info}, {path: error message})."""
+    objects = {}
+    errors = {}
+    semaphore = threading.Semaphore(MAX_HEAD_OBJECT_THREADS)
+
+    def head(path):
+        with semaphore:
+            try:
+                objects[path] = head_object(path, endpoint_url)
+            except (OSError, ValueError) as err:
+                errors[path] = str(err)
+
+    threads = []
+    for path in set(s3_paths):
+        t = threading.Thread(target=head, args=[path])
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return objects, errors
+
+
+def validate_s3_files(s3_paths, endpoint_url=None):
+    """Check that S3 sources exist, are readable and are not empty. Returns the set of invalid paths."""
+    s3_paths = [p for p in s3_paths if is_s3_path(p)]
+    if not s3_paths:
+        return set()
+
+    print("Checking {} S3 file(s)...".format(len(set(s3_paths))))
+    objects, errors = head_objects(s3_paths, endpoint_url)
+    for path, info in objects.items():
+        if info["size"] == 0:
+            errors[path] = "File is empty"
+
+    for path in sorted(errors):
+        print("ERROR: {} ({})".format(path, errors[path]))
+    valid_sizes = [info["size"] for path, info in objects.items() if path not in errors]
+    print("{} S3 file(s) OK, {:.1f} GB total".format(len(valid_sizes), sum(valid_sizes) / 1E9))
+    return set(errors)
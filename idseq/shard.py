@@ -0,0 +1,176 @@
+"""Module for splitting one bulk upload across several hosts."""
+
+from __future__ import print_function
+import argparse
+import errno
+import os
+import time
+
+from . import cache
+
+# Merged reports keep the best outcome when a sample appears in several of them
+STATUS_PRIORITY = ["failed", "uploaded"]
+# Claims older than this are assumed to be left behind by a host that died
+CLAIM_TTL_HOURS = 24
+
+
+def parse_shard(value):
+    """Parse "i/N" (0 <= i < N) for --shard."""
+    try:
+        index, count = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be between 0 and N-1")
+    return index, count
+
+
+def stable_hash(value):
+    import hashlib
+
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest(), 16)
+
+
+def in_shard(sample_name, shard):
+    # md5 rather than hash() so every host assigns samples the same way
+    index, count = shard
+    return stable_hash(sample_name) % count == index
+
+
+def claim_path(claim_dir, base_url, project_id, sample_name):
+    key = "{} {} {}".format(base_url, project_id, sample_name)
+    return os.path.join(claim_dir, "{:032x}.claim".format(stable_hash(key)))
+
+
+def claim(claim_dir, base_url, project_id, sample_name, ttl_hours=CLAIM_TTL_HOURS):
+    """Atomically claim a sample for this host. Returns False if another host already claimed it.
+
+    A claim is taken over if the process that made it is no longer running on this host, or if it
+    is older than ttl_hours (e.g. its host crashed).
+    """
+    import socket
+
+    if not os.path.isdir(claim_dir):
+        try:
+            os.makedirs(claim_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    path = claim_path(claim_dir, base_url, project_id, sample_name)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        if not remove_stale_claim(path, ttl_hours):
+            return False
+        return claim(claim_dir, base_url, project_id, sample_name, ttl_hours)
+    with os.fdopen(fd, "w") as f:
+        f.write("{}\t{}\t{}\t{}\n".format(sample_name, socket.gethostname(), os.getpid(), int(time.time())))
+    return True
+
+
+def read_claim(path):
+    # Returns (sample name, host, pid, timestamp), or None if the claim is gone or still being written
+    try:
+        with open(path) as f:
+            sample_name, host, pid, timestamp = f.read().rstrip("\n").split("\t")
+        return sample_name, host, int(pid), int(timestamp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_running(pid):
+    if os.name != "posix":
+        return True  # os.kill would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def is_stale(claim_info, ttl_hours):
+    import socket
+
+    _, host, pid, timestamp = claim_info
+    if time.time() - timestamp > ttl_hours * 60 * 60:
+        return True
+    return host == socket.gethostname() and not is_running(pid)
+
+
+def remove_stale_claim(path, ttl_hours):
+    """Remove the claim at path if it is stale. Returns True if it was removed."""
+    import socket
+
+    claim_info = read_claim(path)
+    if not claim_info or not is_stale(claim_info, ttl_hours):
+        return False
+    # Move it aside first so only one host removes it. If another host already replaced it with
+    # a fresh claim, put that one back.
+    moved = "{}.{}.{}.stale".format(path, socket.gethostname(), os.getpid())
+    try:
+        os.rename(path, moved)
+    except OSError:
+        return False
+    if read_claim(moved) != claim_info:
+        if not os.path.exists(path):
+            os.rename(moved, path)
+        else:
+            os.remove(moved)
+        return False
+    os.remove(moved)
+    print("Taking over the claim on \"{}\" left by {} (pid {})".format(*claim_info[:3]))
+    return True
+
+
+def release(claim_dir, base_url, project_id, sample_name):
+    """Give up a claim so another host (or a later run) can try the sample."""
+    try:
+        os.remove(claim_path(claim_dir, base_url, project_id, sample_name))
+    except OSError:
+        pass
+
+
+class Report():
+    """Per-host record of the samples it uploaded, saved after every sample so it survives crashes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.samples = cache.load_json(path, {})
+
+    def add(self, sample_name, files, sample_id):
+        import socket
+
+        self.samples[sample_name] = {
+            "status": "uploaded" if sample_id else "failed",
+            "sample_id": sample_id,
+            "files": [f for f in files if f],
+            "host": socket.gethostname(),
+        }
+        cache.save_json(self.path, self.samples)
+
+
+def merge_reports(paths):
+    """Combine several hosts' reports into {sample name: entry}."""
+    merged = {}
+    for path in paths:
+        report = cache.load_json(path)
+        if report is None:
+            print("Could not read report: {}".format(path))
+            continue
+        for sample_name, entry in report.items():
+            current = merged.get(sample_name)
+            if not current or \
+                    STATUS_PRIORITY.index(entry["status"]) > STATUS_PRIORITY.index(current["status"]):
+                merged[sample_name] = entry
+    return merged
+
+
+def print_report_summary(report):
+    failed = sorted(s for s, entry in report.items() if entry["status"] == "failed")
+    hosts = set(entry["host"] for entry in report.values())
+    print("{} sample(s) uploaded, {} failed, from {} host(s)".format(
+        len(report) - len(failed), len(failed), len(hosts)))
+    for sample_name in failed:
+        print("{:20}{} ({})".format("Failed:", sample_name, report[sample_name]["host"]))
@@ -0,0 +1,80 @@
+"""Module for remembering which local files have already been uploaded."""
+
+import os
+import threading
+
+from . import cache
+
+INDEX_FILE = "upload_index.json"
+HASH_SAMPLE_SIZE = 1024 ** 2  # 1 Mb from each end of the file
+
+
+def partial_hash(path, size):
+    """Fast content fingerprint: md5 of the first and last HASH_SAMPLE_SIZE bytes."""
+    import hashlib
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        md5.update(f.read(HASH_SAMPLE_SIZE))
+        if size > HASH_SAMPLE_SIZE:
+            f.seek(max(size - HASH_SAMPLE_SIZE, HASH_SAMPLE_SIZE))
+            md5.update(f.read(HASH_SAMPLE_SIZE))
+    return md5.hexdigest()
+
+
+def file_key(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return "{}|{}|{}|{}".format(path, st.st_size, int(st.st_mtime), partial_hash(path, st.st_size))
+
+
+class UploadIndex():
+    """Maps local files (path, size, mtime and partial hash) to the sample they were uploaded as."""
+
+    def __init__(self, path=None):
+        self.path = path or cache.cache_path(INDEX_FILE)
+        self.entries = cache.load_json(self.path, {})
+        self.lock = threading.Lock()
+
+    def file_keys(self, files):
+        # Only local files can be indexed
+        if any(f.startswith("s3://") for f in files):
+            return None
+        return [file_key(f) for f in files]
+
+    def lookup(self, base_url, project_id, files):
+        """Return the entry for a sample whose files are all unchanged since they were uploaded."""
+        keys = self.file_keys(files)
+        if not keys:
+            return None
+        entries = [self.entries.get(k) for k in keys]
+        if entries[0] and entries[0]["url"] == base_url and entries[0]["project_id"] == project_id and \
+                all(e == entries[0] for e in entries):
+            return entries[0]
+        return None
+
+    def lookup_sample_name(self, base_url, project_id, sample_name):
+        for entry in self.entries.values():
+            if entry["url"] == base_url and entry["project_id"] == project_id and entry["sample_name"] == sample_name:
+                return entry
+        return None
+
+    def record(self, base_url, project_id, sample_name, sample_id, files):
+        keys = self.file_keys(files)
+        if not keys:
+            return
+        entry = {"url": base_url, "project_id": project_id, "sample_name": sample_name, "sample_id": sample_id}
+        with self.lock:
+            # Reload so concurrent CLI processes don't drop each other's entries
+            self.entries = cache.load_json(self.path, {})
+            self.entries.update((k, entry) for k in keys)
+            cache.save_json(self.path, self.entries)
+
+    def remove(self, base_url, project_id, sample_id):
+        """Forget the files of a sample, e.g. because IDseq could not process them."""
+        with self.lock:
+            self.entries = cache.load_json(self.path, {})
+            for key, entry in list(self.entries.items()):
+                if entry["url"] == base_url and entry["project_id"] == project_id and entry["sample_id"] == sample_id:
+                    del self.entries[key]
+            cache.save_json(self.path, self.entries)
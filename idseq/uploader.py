@@ -1,14 +1,12 @@
-import csv
+from __future__ import print_function
 import glob
 import io
 import json
 import os
-import pkg_resources
 import re
-import requests
 import stat
-import subprocess
 import sys
+import threading
 import time
 
 from builtins import input
@@ -16,16 +14,35 @@ from future.utils import viewitems
 from itertools import product
 from string import ascii_lowercase
 
+from . import __version__
+from . import cache
 from . import constants
 from . import locations
-
-sys.tracebacklimit = 0
+from . import profiling
+from . import s3
 
 DEFAULT_MAX_PART_SIZE_IN_MB = 5000
-INPUT_REGEX = "(.+)\.(fastq|fq|fasta|fa)(\.gz|$)"
-PAIRED_REGEX = "(.+)(_R\d)(_001)?\.(fastq|fq|fasta|fa)(\.gz|$)"
+INPUT_REGEX = r"(.+)\.(fastq|fq|fasta|fa)(\.gz|$)"
+PAIRED_REGEX = r"(.+)(_R\d)(_001)?\.(fastq|fq|fasta|fa)(\.gz|$)"
 PART_SUFFIX = "__AWS-MULTI-PART-"
 BUFFER_SIZE = 1024 ** 2  # 1 Mb
+MAX_EXISTING_SAMPLES = 100000
+PROJECTS_CACHE_FILE = "projects.json"
+PROJECTS_CACHE_TTL = 60 * 60  # seconds
+FINALIZE_TIMEOUT = 10  # seconds to wait for the server to confirm an upload before polling instead
+STATUS_POLL_MIN_DELAY = 2  # seconds
+STATUS_POLL_MAX_DELAY = 60  # seconds
+STATUS_POLL_TIMEOUT = 30 * 60  # seconds
+MAX_STATUS_THREADS = 8  # Up to this many samples are polled one by one instead of listing the project
+STATUS_LISTING_SIZE = 100  # Samples per listing request when polling many samples
+
+
+class UploadError(Exception):
+    """Raised when the server rejects a sample or a transfer fails."""
+
+
+def no_print(*args, **kwargs):
+    pass
 
 
 class File():
@@ -39,41 +56,37 @@ class File():
             return 'local'
 
     def parts(self, max_part_size):
-        # Check if any file is over max_part_size and, if so, chunk
+        # Check if any file is over max_part_size and, if so, name its chunks.
+        # Chunks are only written to disk when they are transferred (see write_part).
         if self.source_type() == 'local' and os.path.getsize(
                 self.path) > max_part_size:
             part_prefix = self.path + PART_SUFFIX
-            return self.split_file(max_part_size, part_prefix)
+            num_parts = len(self.part_ranges(max_part_size))
+            suffixes = list(product(ascii_lowercase, repeat=2))
+            if num_parts > len(suffixes):
+                raise ValueError("File too large: {} would need more than {} parts of {} MB".format(
+                    self.path, len(suffixes), int(max_part_size // 1E6)))
+            return ["{}{}".format(part_prefix, ''.join(suf)) for suf in suffixes[:num_parts]]
         else:
             return [self.path]
 
-    def split_file(self, max_part_size, prefix):
-        # Using MB (10^6) instead of MiB (2^16)
-        print("Splitting large file into {} MB chunks...".format(int(max_part_size // 1E6)))
-        if not os.path.isfile(self.path):
-            print("Sample file not found: {}".format(self.path))
-            return []
+    def part_ranges(self, max_part_size):
+        # (offset, length) of each chunk, computed from the file size alone
+        size = os.path.getsize(self.path)
+        return [(offset, min(max_part_size, size - offset)) for offset in range(0, size, max_part_size)]
 
-        partial_files = []
-        suffix_iter = product(ascii_lowercase, repeat=2)
+    def write_part(self, part_path, part_index, max_part_size):
+        offset, remaining = self.part_ranges(max_part_size)[part_index]
         buffer = memoryview(bytearray(min(BUFFER_SIZE, max_part_size)))
-        with buffer, open(self.path, 'rb') as fread:
-            for suf in suffix_iter:
-                remaining = max_part_size
-                bytes_read = fread.readinto(buffer)
-                if bytes_read:
-                    partial_files.append("{}{}".format(prefix, ''.join(suf)))
-                    with open(partial_files[-1], 'wb') as fwrite:
-                        while bytes_read:
-                            fwrite.write(buffer[:bytes_read])
-                            remaining -= bytes_read
-                            bytes_read = fread.readinto(buffer[:min(remaining, len(buffer))])
-                else:
-                    return partial_files
-
-            # All suffixes have been used
-            print("[ERROR] File too large")
-            remove_files(partial_files)
+        with buffer, open(self.path, 'rb') as fread, open(part_path, 'wb') as fwrite:
+            fread.seek(offset)
+            while remaining:
+                bytes_read = fread.readinto(buffer[:min(remaining, len(buffer))])
+                if not bytes_read:
+                    break
+                fwrite.write(buffer[:bytes_read])
+                remaining -= bytes_read
+        return part_path
 
 
 def build_path(bucket, key):
@@ -86,15 +99,17 @@ def determine_level(file_path, search_key):
     return n_parts_file - n_parts_key
 
 
-def detect_files(path, level=1):
+def detect_files(path, level=1, endpoint_url=None):
     # S3 source (user needs access to the location they're trying to upload from):
     if path.startswith('s3://'):
+        import subprocess
+
         clean_path = path.rstrip('/')
         bucket = path.split("/")[2]
         file_list = subprocess.check_output(
-            "aws s3 ls {}/ --recursive | awk '{{print $4}}'".format(clean_path),
-            shell=True).splitlines()
-        file_list = [f.decode("UTF-8") for f in file_list]
+            s3.aws_command(["s3", "ls", clean_path + "/", "--recursive"], endpoint_url)).splitlines()
+        # Each line is "<date> <time> <size> <key>"
+        file_list = [f.decode("UTF-8").split(None, 3)[3] for f in file_list if f.strip()]
         return [
             build_path(bucket, f)
             for f in file_list
@@ -117,49 +132,68 @@ def clean_samples2files(samples2files):
 
 def remove_files(files):
     for partial_file in files:
-        if PART_SUFFIX in partial_file:
-            os.remove(files)
+        if PART_SUFFIX in partial_file and os.path.isfile(partial_file):
+            os.remove(partial_file)
 
 
-def detect_samples(path):
+def group_files(files, level=1):
     samples2files = {}
-    # First try to find top-level files in the folder.
-    # Paired files for the same sample must be labeled with R1 and R2 as indicated in PAIRED_REGEX
-    files_level1 = detect_files(path, level=1)
-    if files_level1:
-        for f in files_level1:
+    for f in files:
+        if level == 1:
             m2 = re.search(PAIRED_REGEX, f)
             m = re.search(INPUT_REGEX, f)
             sample_name = os.path.basename(
                 m2.group(1)) if m2 else os.path.basename(m.group(1))
-            samples2files[sample_name] = samples2files.get(sample_name, []) + [f]
-        return clean_samples2files(samples2files)
+        else:
+            sample_name = os.path.basename(os.path.dirname(f))
+        samples2files[sample_name] = samples2files.get(sample_name, []) + [f]
+    return samples2files
+
+
+def detect_samples(path, endpoint_url=None, verbose=True):
+    # First try to find top-level files in the folder.
+    # Paired files for the same sample must be labeled with R1 and R2 as indicated in PAIRED_REGEX
+    files_level1 = detect_files(path, level=1, endpoint_url=endpoint_url)
+    if files_level1:
+        return clean_samples2files(group_files(files_level1, level=1))
     # If there are no top-level files, try to find them in subfolders.
     # In this case, each subfolder corresponds to one sample.
-    files_level2 = detect_files(path, level=2)
+    files_level2 = detect_files(path, level=2, endpoint_url=endpoint_url)
     if files_level2:
-        for f in files_level2:
-            sample_name = os.path.basename(os.path.dirname(f))
-            samples2files[sample_name] = samples2files.get(sample_name, []) + [f]
-        return clean_samples2files(samples2files)
+        return clean_samples2files(group_files(files_level2, level=2))
     # If there are still no suitable files, tell the user hopw folders must be structured.
-    print(
-        "\n\nNo fastq/fasta files found in this folder.\n"
-        "Files can have extensions fastq/fq/fasta/fa "
-        "with optionally the additional extension gz.\n"
-        "If the folder you specified has no sub-directories, "
-        "paired files need to be indicated using the labels _R1 and _R2 before the "
-        "extension, otherwise each file will be treated as a separate sample. Sample names "
-        "will be derived from file names with the extensions and any R1/R2 labels trimmed off.\n"
-        "Alternatively, your folder can be structured to have one subfolder per sample. "
-        "In that case, the name of the subfolder will be used as the sample name.\n"
-        "Example names: RR004_water_2_S23_R1_001.fastq.gz and RR004_water_2_S23_R2_001.fastq.gz"
-    )
-    raise ValueError()
-
-
-def upload(sample_name, project_id, headers, url, r1, r2, chunk_size, csv_metadata):
-    print("\nPreparing to upload sample \"{}\" ...".format(sample_name))
+    if verbose:
+        print(
+            "\n\nNo fastq/fasta files found in this folder.\n"
+            "Files can have extensions fastq/fq/fasta/fa "
+            "with optionally the additional extension gz.\n"
+            "If the folder you specified has no sub-directories, "
+            "paired files need to be indicated using the labels _R1 and _R2 before the "
+            "extension, otherwise each file will be treated as a separate sample. Sample names "
+            "will be derived from file names with the extensions and any R1/R2 labels trimmed off.\n"
+            "Alternatively, your folder can be structured to have one subfolder per sample. "
+            "In that case, the name of the subfolder will be used as the sample name.\n"
+            "Example names: RR004_water_2_S23_R1_001.fastq.gz and RR004_water_2_S23_R2_001.fastq.gz"
+        )
+    raise ValueError(
+        "No fastq/fasta files found in {}. Put them in the folder itself (paired files labeled _R1 and _R2) "
+        "or in one subfolder per sample".format(path))
+
+
+def upload(sample_name, project_id, headers, url, r1, r2, chunk_size, csv_metadata, session=None, verbose=True,
+           wait=True):
+    """Register a sample and transfer its files. Returns the sample id or raises UploadError.
+
+    Pass a requests.Session to reuse pooled connections across samples, and verbose=False to
+    upload without printing progress. With wait=False, return as soon as the server has been told
+    the files are transferred, without waiting for it to process them; use wait_for_samples to
+    get the final status of many samples at once.
+    """
+    import requests
+
+    http = session or requests
+    log = print if verbose else no_print
+    log("\nPreparing to upload sample \"{}\" ...".format(sample_name))
 
     files = [File(r1)]
     if r2:
@@ -170,23 +204,17 @@ def upload(sample_name, project_id, headers, url, r1, r2, chunk_size, csv_metada
     # Raise exception if a file is empty
     if source_type == 'local' and any(
             os.stat(f.path).st_size == 0 for f in files):
-        print("ERROR: input file must not be empty")
-        raise ValueError()
+        raise ValueError("input file must not be empty")
 
     if r2 and files[0].source_type() != files[1].source_type():
-        print("ERROR: input files must be same type")
-        raise ValueError()
+        raise ValueError("input files must be same type")
 
     # Clamp max_part_size to a valid value
     max_part_size = int(max(min(DEFAULT_MAX_PART_SIZE_IN_MB, chunk_size), 1) * 1E6)
 
-    # Get version of CLI from setuptools
-    version = pkg_resources.require("idseq")[0].version
-
     host_genome_name = pop_match_in_dict(constants.HOST_GENOME_ALIASES, csv_metadata)
     if not host_genome_name:
-        print("ERROR: no host organism in CSV")
-        raise ValueError()
+        raise ValueError("no host organism in CSV")
 
     all_file_parts = [f.parts(max_part_size) for f in files]
     data = {
@@ -208,26 +236,24 @@ def upload(sample_name, project_id, headers, url, r1, r2, chunk_size, csv_metada
             }
         ],
         "metadata": {sample_name: csv_metadata},
-        "client": version
+        "client": __version__
     }
 
-    raw_resp = requests.post(
-        url + '/samples/bulk_upload_with_metadata.json', data=json.dumps(data), headers=headers)
-    resp = raw_resp.json()
+    with profiling.phase("registration"):
+        raw_resp = http.post(
+            url + '/samples/bulk_upload_with_metadata.json', data=json.dumps(data), headers=headers)
+        resp = raw_resp.json()
 
     if raw_resp.status_code == 200:
         if len(resp.get("errors", {})) == 0:
-            print("Connected to the server.")
+            log("Connected to the server.")
         else:
-            print("\nFailed. Error response from IDseq server: {}".format(resp["errors"]))
-            remove_files(all_file_parts)
-            return
+            raise UploadError("Error response from IDseq server: {}".format(resp["errors"]))
     else:
         # Handle potential responses without proper error fields
-        print("\nFailed. Error response: {}".format(resp))
-        remove_files(all_file_parts)
-        return
+        raise UploadError("Error response: {}".format(resp))
 
+    sample_id = resp["sample_ids"][0]
     if source_type == 'local':
         sample_data = resp["samples"][0]
         num_files = len(sample_data["input_files"])
@@ -235,57 +261,169 @@ def upload(sample_name, project_id, headers, url, r1, r2, chunk_size, csv_metada
             msg = "1 file to upload..."
         else:
             msg = "{} files to upload...".format(num_files)
-        print(msg)
+        log(msg)
         time.sleep(1)
 
+        # Map the part names registered above back to their source file and chunk index
+        local_parts = {}
+        for f, file_parts in zip(files, all_file_parts):
+            for part_index, part in enumerate(file_parts):
+                local_parts[os.path.basename(part)] = (f, part_index, part)
+
         for raw_input_file in sample_data['input_files']:
             presigned_urls = raw_input_file['presigned_url'].split(", ")
             input_parts = raw_input_file["parts"].split(", ")
             for part_index, file in enumerate(input_parts):
                 presigned_url = presigned_urls[part_index]
-                print('Uploading {} (part {} of {})...'.format(
+                log('Uploading {} (part {} of {})...'.format(
                     file, part_index, len(input_parts)
                 ))
-                with Tqio(file, part_index, num_files) as f:
-                    resp_put = requests.put(presigned_url, data=f)
-                    if resp_put.status_code != 200:
-                        print('Sample was not successfully uploaded. Status code: {}, '
-                              'Input file: {}, Sample name: {}'.format(str(resp_put.status_code),
-                                                                       str(file),
-                                                                       str(sample_name)))
-                        remove_files(all_file_parts)
-                        return
-                if PART_SUFFIX in file:
-                    os.remove(file)
-
-        # Mark as uploaded
-        sample_id = resp["sample_ids"][0]
-        update = {
-            "sample": {
-                "id": sample_id,
-                "name": sample_name,
-                "status": "uploaded"
-            }
+                source, chunk_index, part_path = local_parts.get(file, (None, None, file))
+                if source is not None and PART_SUFFIX in part_path:
+                    # Using MB (10^6) instead of MiB (2^16)
+                    log("Preparing {} MB chunk {}...".format(int(max_part_size // 1E6), file))
+                    with profiling.phase("split"):
+                        source.write_part(part_path, chunk_index, max_part_size)
+                try:
+                    with profiling.phase("transfer"):
+                        with Tqio(part_path, part_index, num_files, verbose) as f:
+                            resp_put = http.put(presigned_url, data=f)
+                finally:
+                    remove_files([part_path])
+                if resp_put.status_code != 200:
+                    raise UploadError('Sample was not successfully uploaded. Status code: {}, '
+                                      'Input file: {}, Sample name: {}'.format(str(resp_put.status_code),
+                                                                               str(file),
+                                                                               str(sample_name)))
+
+        with profiling.phase("finalize"):
+            confirmed = mark_uploaded(url, headers, sample_id, sample_name, session)
+        if not confirmed:
+            if not wait:
+                log("Sample is being processed on our server.")
+                return sample_id
+            status, error = wait_for_samples(url, headers, project_id, [sample_id], session, verbose)[sample_id]
+            if status == "failed":
+                raise UploadError("IDseq could not process the uploaded files: {}".format(error))
+            elif status == "processing":
+                log("Sample is still being processed on our server. Check for status on IDseq {}".format(url))
+                return sample_id
+
+    log("All done!")
+    return sample_id
+
+
+def mark_uploaded(url, headers, sample_id, sample_name, session=None):
+    """Tell the server all files are transferred. Returns True if it confirmed, False if it is still processing."""
+    import requests
+
+    http = session or requests
+    update = {
+        "sample": {
+            "id": sample_id,
+            "name": sample_name,
+            "status": "uploaded"
         }
-
-        resp = requests.put(
+    }
+    try:
+        resp = http.put(
             '{}/samples/{}.json'.format(url, sample_id),
             data=json.dumps(update),
-            headers=headers)
+            headers=headers,
+            timeout=(None, FINALIZE_TIMEOUT))
+    except requests.exceptions.ReadTimeout:
+        return False
+
+    # idseq-web concatenates multipart files while handling this request, so the gateway may time out
+    if resp.status_code in [502, 503, 504]:
+        return False
+    elif resp.status_code != 200:
+        raise UploadError('Sample was not successfully uploaded. Status code: {}, '
+                          'Sample name: {}'.format(str(resp.status_code), str(sample_name)))
+    return True
+
+
+def get_sample_status(url, headers, sample_id, session=None):
+    """Return ("uploaded" | "failed" | "processing", upload error) for a sample."""
+    import requests
+
+    http = session or requests
+    resp = http.get('{}/samples/{}.json'.format(url, sample_id), headers=headers)
+    resp.raise_for_status()
+    return parse_sample_status(resp.json())
+
+
+def parse_sample_status(sample):
+    """Return ("uploaded" | "failed" | "processing", upload error) from a sample returned by the server."""
+    # Project sample listings nest the sample record under details
+    sample = sample.get("details", {}).get("db_sample") or sample
+    if sample.get("upload_error"):
+        return "failed", sample["upload_error"]
+    elif sample.get("status") in ["uploaded", "checked"]:
+        return "uploaded", None
+    return "processing", None
+
+
+def get_sample_statuses(url, headers, project_id, sample_ids, session=None):
+    """Return {sample id: (status, error)} as from get_sample_status for the samples that could be fetched.
+
+    Many samples are fetched in batches of STATUS_LISTING_SIZE from the project sample listing,
+    filtered to those samples. A few samples, and any that are missing from the listing, are
+    fetched concurrently one by one.
+    """
+    import requests
+
+    statuses = {}
+    if len(sample_ids) > MAX_STATUS_THREADS:
+        for i in range(0, len(sample_ids), STATUS_LISTING_SIZE):
+            batch = sample_ids[i:i + STATUS_LISTING_SIZE]
+            listed = get_project_samples(url, headers, project_id, session, sample_ids=batch) or {}
+            wanted = set(batch)
+            statuses.update(
+                (sample_id, (status, error)) for sample_id, status, error in listed.values() if sample_id in wanted
+            )
 
-        has_file_parts = any(len(parts) > 1 for parts in all_file_parts)
-        if resp.status_code == 504 and has_file_parts:
-            # Note: Not ideal, but for now idseq-web times out trying to concatenate file parts on the server
-            print('Sample is being processed on our server. Check for status on IDseq https://idseq.net')
-            remove_files(all_file_parts)
-            return
-        elif resp.status_code != 200:
-            print('Sample was not successfully uploaded. Status code: {}, '
-                  'Sample name: {}'.format(str(resp.status_code), str(sample_name)))
-            remove_files(all_file_parts)
-            return
+    semaphore = threading.Semaphore(MAX_STATUS_THREADS)
 
-    print("All done!")
+    def fetch(sample_id):
+        with semaphore:
+            try:
+                statuses[sample_id] = get_sample_status(url, headers, sample_id, session)
+            except (ValueError, requests.exceptions.RequestException):
+                pass  # Try again next round
+
+    threads = []
+    for sample_id in sample_ids:
+        if sample_id not in statuses:
+            t = threading.Thread(target=fetch, args=[sample_id])
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+    return statuses
+
+
+def wait_for_samples(url, headers, project_id, sample_ids, session=None, verbose=True, timeout=STATUS_POLL_TIMEOUT):
+    """Poll the server until each of the samples has finished processing.
+
+    Samples are polled together in rounds with exponential backoff between rounds; timeout=0 polls
+    once. Returns {sample id: (status, error)} as from get_sample_status; samples still processing
+    after timeout seconds have status "processing".
+    """
+    log = print if verbose else no_print
+    results = dict((sample_id, ("processing", None)) for sample_id in sample_ids)
+    pending = list(results)
+    delay = STATUS_POLL_MIN_DELAY
+    deadline = time.time() + timeout
+    with profiling.phase("finalize"):
+        log("\nWaiting for IDseq to process {} sample(s)...".format(len(pending)))
+        while True:
+            results.update(get_sample_statuses(url, headers, project_id, pending, session))
+            pending = [sample_id for sample_id in pending if results[sample_id][0] == "processing"]
+            if not pending or time.time() + delay > deadline:
+                return results
+            time.sleep(delay)
+            delay = min(delay * 2, STATUS_POLL_MAX_DELAY)
 
 
 def get_user_agreement():
@@ -315,6 +453,8 @@ def print_metadata_instructions():
 
 
 def get_user_metadata(base_url, headers, sample_names, project_id, metadata_file=None):
+    import requests
+
     instructions_printed = False
 
     if not metadata_file:
@@ -329,28 +469,8 @@ def get_user_metadata(base_url, headers, sample_names, project_id, metadata_file
     errors = [-1]
     while len(errors) != 0:
         try:
-            try:
-                with io.open(metadata_file, 'r', encoding='utf-8') as f:
-                    csv_data = list(csv.reader(f))
-            # If a Unicode error is thrown, it's possible that the user has generated
-            # a CSV from Excel that uses latin-1 encoding. Try alternate encoding.
-            except UnicodeDecodeError:
-                with io.open(metadata_file, 'r', encoding='latin-1') as f:
-                    csv_data = list(csv.reader(f))
-
-            # Format data for the validation endpoint
-            data = {
-                "metadata": {"headers": csv_data[0], "rows": csv_data[1:]},
-                "samples": [
-                    {"name": name, "project_id": project_id} for name in sample_names
-                ],
-            }
-            resp = requests.post(
-                base_url + "/metadata/validate_csv_for_new_samples.json",
-                data=json.dumps(data),
-                headers=headers,
-            )
-            errors = display_metadata_errors(resp)
+            issues = validate_metadata(base_url, headers, sample_names, project_id, metadata_file)
+            errors = display_metadata_errors(issues)
         except (OSError, ValueError, requests.exceptions.RequestException) as err:
             errors = [str(err)]
             print(errors)
@@ -364,22 +484,60 @@ def get_user_metadata(base_url, headers, sample_names, project_id, metadata_file
             metadata_file = resp or metadata_file
         else:
             print("\nCSV validation successful!")
-
-            # Send metadata as { sample_name => {metadata_key: value} }
-            csv_data = {}
-            with open(metadata_file) as file_data:
-                for row in list(csv.DictReader(file_data)):
-                    name = pop_match_in_dict(["sample_name", "Sample Name"], row)
-                    csv_data[name] = row
+            csv_data = load_metadata(metadata_file)
             csv_data = locations.geosearch_and_set_csv_locations(base_url, headers, csv_data, project_id)
             return csv_data
 
 
-# Display issues with the submitted metadata CSV based on the server response
-def display_metadata_errors(resp):
-    resp = json.loads(resp.text)
-    issues = resp.get("issues", {})
+def read_metadata_csv(metadata_file, as_dicts=False):
+    import csv
+
+    reader = csv.DictReader if as_dicts else csv.reader
+    try:
+        with io.open(metadata_file, 'r', encoding='utf-8') as f:
+            return list(reader(f))
+    # If a Unicode error is thrown, it's possible that the user has generated
+    # a CSV from Excel that uses latin-1 encoding. Try alternate encoding.
+    except UnicodeDecodeError:
+        with io.open(metadata_file, 'r', encoding='latin-1') as f:
+            return list(reader(f))
+
+
+def validate_metadata(base_url, headers, sample_names, project_id, metadata_file, session=None):
+    """Validate a metadata CSV on the server. Returns the issues found, i.e. {"errors": [...], "warnings": [...]}."""
+    import requests
+
+    http = session or requests
+    with profiling.phase("metadata"):
+        csv_data = read_metadata_csv(metadata_file)
+
+        # Format data for the validation endpoint
+        data = {
+            "metadata": {"headers": csv_data[0], "rows": csv_data[1:]},
+            "samples": [
+                {"name": name, "project_id": project_id} for name in sample_names
+            ],
+        }
+        resp = http.post(
+            base_url + "/metadata/validate_csv_for_new_samples.json",
+            data=json.dumps(data),
+            headers=headers,
+        )
+        return json.loads(resp.text).get("issues", {})
+
+
+def load_metadata(metadata_file):
+    # Metadata as { sample_name => {metadata_key: value} }
+    csv_data = {}
+    with profiling.phase("metadata"):
+        for row in read_metadata_csv(metadata_file, as_dicts=True):
+            name = pop_match_in_dict(["sample_name", "Sample Name"], row)
+            csv_data[name] = row
+    return csv_data
 
+
+# Display issues with the submitted metadata CSV based on the server response
+def display_metadata_errors(issues):
     # Show a section for errors and warnings
     for issue_type in ["errors", "warnings"]:
         group = issues.get(issue_type, {})
@@ -398,17 +556,19 @@ def display_metadata_errors(resp):
 
 
 def validate_project(base_url, headers, project_name):
+    import requests
+
     print("Checking project name...")
-    params = {"basic": True}
-    resp = requests.get(base_url + "/projects.json", params=params, headers=headers)
-    if resp.status_code == 401:
+    try:
+        names_to_ids = list_projects(base_url, headers)
+        if project_name not in names_to_ids:
+            # The cached list may predate the project, so check with the server
+            names_to_ids = list_projects(base_url, headers, max_age=0)
+    except requests.exceptions.HTTPError as err:
+        if err.response.status_code != 401:
+            raise
         print("Invalid email or token. Please double-check your formatting and try again.")
         quit()
-    all_projects = resp.json()
-    names_to_ids = {}
-
-    for project in all_projects["projects"]:
-        names_to_ids[project["name"]] = project["id"]
 
     while project_name not in names_to_ids:
         user_resp = input("\nProject does not exist. Press Enter to create. Or check a different "
@@ -416,22 +576,115 @@ def validate_project(base_url, headers, project_name):
         if user_resp:
             project_name = user_resp
         else:
-            # Create the project
-            resp = requests.post(
-                base_url + "/projects.json",
-                data=json.dumps({"project": {"name": project_name}}),
-                headers=headers
-            )
-            if resp.status_code == 422:
-                print("Project name is too similar to an existing project. Please try another name.")
+            try:
+                project_name, project_id = create_project(base_url, headers, project_name)
+            except ValueError as err:
+                print(err)
                 continue
-            resp = resp.json()
             print("Project created!")
-            return resp["name"], resp["id"]
+            return project_name, project_id
 
     return project_name, names_to_ids[project_name]
 
 
+def list_projects(base_url, headers, session=None, max_age=PROJECTS_CACHE_TTL):
+    """Return {project name: project id} for every project the user can see.
+
+    The list is cached locally for max_age seconds. After that it is revalidated with the server's
+    ETag, so it is only downloaded again if it changed.
+    """
+    import requests
+
+    http = session or requests
+    cache_file = cache.cache_path(PROJECTS_CACHE_FILE)
+    all_cached = cache.load_json(cache_file, {})
+    cache_key = "{} {}".format(base_url, headers.get("X-User-Email"))
+    cached = all_cached.get(cache_key)
+    if cached and time.time() - cached["fetched_at"] < max_age:
+        return cached["projects"]
+
+    request_headers = dict(headers)
+    if cached and cached.get("etag"):
+        request_headers["If-None-Match"] = cached["etag"]
+    resp = http.get(base_url + "/projects.json", params={"basic": True}, headers=request_headers)
+    if resp.status_code == 304 and cached:
+        projects = cached["projects"]
+    else:
+        resp.raise_for_status()
+        projects = {project["name"]: project["id"] for project in resp.json()["projects"]}
+
+    all_cached[cache_key] = {"etag": resp.headers.get("ETag"), "fetched_at": time.time(), "projects": projects}
+    try:
+        cache.save_json(cache_file, all_cached)
+    except (IOError, OSError):
+        pass  # The cache is only an optimization
+    return projects
+
+
+def get_project(base_url, headers, project_id, session=None):
+    """Return the (name, id) of the project with this id."""
+    import requests
+
+    http = session or requests
+    resp = http.get("{}/projects/{}.json".format(base_url, project_id), headers=headers)
+    resp.raise_for_status()
+    project = resp.json()
+    return project["name"], project["id"]
+
+
+def validate_project_id(base_url, headers, project_id):
+    import requests
+
+    print("Checking project id...")
+    try:
+        return get_project(base_url, headers, project_id)
+    except requests.exceptions.HTTPError as err:
+        if err.response.status_code == 401:
+            print("Invalid email or token. Please double-check your formatting and try again.")
+        else:
+            print("Project {} does not exist or you do not have access to it.".format(project_id))
+        quit()
+
+
+def create_project(base_url, headers, project_name, session=None):
+    """Create a project and return its (name, id). Raises ValueError if the name is taken."""
+    import requests
+
+    http = session or requests
+    resp = http.post(
+        base_url + "/projects.json",
+        data=json.dumps({"project": {"name": project_name}}),
+        headers=headers
+    )
+    if resp.status_code == 422:
+        raise ValueError("Project name is too similar to an existing project. Please try another name.")
+    resp = resp.json()
+    return resp["name"], resp["id"]
+
+
+def get_project_samples(base_url, headers, project_id, session=None, sample_ids=None):
+    """Fetch {name: (sample id, status, upload error)} for the samples in the project, or None if they can't be listed.
+
+    Pass sample_ids to only list those samples. status is as from parse_sample_status. A sample
+    that was registered but whose files never finished transferring stays "processing".
+    """
+    import requests
+
+    http = session or requests
+    params = {"projectId": project_id, "limit": MAX_EXISTING_SAMPLES}
+    if sample_ids:
+        params.update({"sampleIds[]": list(sample_ids), "limit": len(sample_ids)})
+    try:
+        resp = http.get(base_url + "/samples/index_v2.json", params=params, headers=headers)
+        if resp.status_code == 200:
+            return dict(
+                (sample["name"], (sample["id"],) + parse_sample_status(sample)) for sample in resp.json()["samples"]
+            )
+    except (ValueError, KeyError, requests.exceptions.RequestException):
+        pass
+    return None
+
+
 def pop_match_in_dict(keys, dictionary):
     for k in keys:
         if k in dictionary:
@@ -439,14 +692,17 @@ def pop_match_in_dict(keys, dictionary):
 
 
 class Tqio(io.BufferedReader):
-    def __init__(self, file_path, i, count):
+    def __init__(self, file_path, i, count, verbose=True):
         super(Tqio, self).__init__(io.open(file_path, "rb"))
+        self.verbose = verbose
         self.progress = 0
         self.chunk_idx = 0
         self.total = os.path.getsize(file_path)
         self.done = False
 
     def write_stdout(self, msg):
+        if not self.verbose:
+            return
         sys.stdout.write(msg)
         sys.stdout.flush()
 
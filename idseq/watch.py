@@ -0,0 +1,178 @@
+"""Module for uploading samples while a sequencer run folder is still being written."""
+
+from __future__ import print_function
+import glob
+import os
+import re
+import time
+
+from . import cache
+from . import uploader
+
+POLL_INTERVAL = 30  # seconds
+STABLE_SECONDS = 120  # A file is complete once its size and mtime haven't changed for this long
+# Written by Illumina instruments when the whole run is done
+RUN_COMPLETE_MARKERS = ["RTAComplete.txt", "CopyComplete.txt"]
+# A file is also complete as soon as e.g. sample_R1.fastq.gz.done exists next to it
+FILE_COMPLETE_SUFFIXES = [".done", ".md5"]
+
+
+def open_inotify():
+    """Return an inotify instance, or None to fall back to polling."""
+    try:
+        from inotify_simple import INotify
+        return INotify()
+    except (ImportError, OSError):
+        return None
+
+
+def is_input_file(f):
+    # Completion markers (sample_R1.fastq.gz.done) and chunks written during upload also match INPUT_REGEX
+    if uploader.PART_SUFFIX in f or any(f.endswith(suffix) for suffix in FILE_COMPLETE_SUFFIXES):
+        return False
+    return re.search(uploader.INPUT_REGEX, f) is not None
+
+
+def state_path(path, base_url, project_id):
+    import hashlib
+
+    key = "{} {} {}".format(os.path.abspath(path), base_url, project_id)
+    return cache.cache_path("watch_{}.json".format(hashlib.md5(key.encode("utf-8")).hexdigest()[:16]))
+
+
+class RunFolderWatcher():
+    """Tracks which fastq/fasta files in a folder are complete and groups them into samples."""
+
+    def __init__(self, path, stable_seconds=STABLE_SECONDS, poll_interval=POLL_INTERVAL):
+        self.path = path.rstrip("/") or "/"
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.last_change = {}  # file -> ((size, mtime), time that signature was first seen)
+        self.closed = set()  # files closed after writing or moved into place, as reported by inotify
+        self.watched_dirs = {}  # inotify watch descriptor -> directory
+        self.invalid = set()  # samples with too many files, reported once
+        self.inotify = open_inotify()
+        if self.inotify:
+            self.watch_folders()
+
+    def is_run_complete(self):
+        return any(os.path.exists(os.path.join(self.path, m)) for m in RUN_COMPLETE_MARKERS)
+
+    def list_files(self, level):
+        return [f for f in glob.glob(self.path + "/*" * level) if is_input_file(f)]
+
+    def is_complete(self, f, now):
+        try:
+            st = os.stat(f)
+        except OSError:
+            return False
+        signature = (st.st_size, st.st_mtime)
+        previous = self.last_change.get(f)
+        unchanged = previous is not None and previous[0] == signature
+        if not unchanged:
+            self.last_change[f] = previous = (signature, now)
+        if st.st_size == 0:
+            return False
+        # Closed after writing, and not written to again since the last check
+        if f in self.closed and unchanged:
+            return True
+        if any(os.path.exists(f + suffix) for suffix in FILE_COMPLETE_SUFFIXES):
+            return True
+        return now - previous[1] >= self.stable_seconds
+
+    def ready_samples(self, run_complete):
+        """Return ({sample: files} ready to upload, names of samples still being written)."""
+        if self.inotify:
+            self.watch_folders()
+        now = time.time()
+        ready = {}
+        pending = []
+        for level in [1, 2]:
+            files = self.list_files(level)
+            complete = set(f for f in files if self.is_complete(f, now))
+            for sample, sample_files in uploader.group_files(files, level).items():
+                if sample in ready:
+                    continue
+                if len(sample_files) > 2:
+                    if sample not in self.invalid:
+                        self.invalid.add(sample)
+                        print("Skipping sample \"{}\": more than 2 input files ({})".format(
+                            sample, ", ".join(sorted(os.path.basename(f) for f in sample_files))))
+                    continue
+                if not complete.issuperset(sample_files):
+                    pending.append(sample)
+                elif len(sample_files) == 2 or run_complete or \
+                        (level == 1 and not re.search(uploader.PAIRED_REGEX, sample_files[0])):
+                    ready[sample] = sorted(sample_files)
+                else:
+                    # An R1 without its R2 yet, or a subfolder with one file so far
+                    pending.append(sample)
+        return ready, pending
+
+    def watch_folders(self):
+        # Watch the folder itself and any sample subfolders created since the last check
+        from inotify_simple import flags
+        for d in [self.path] + [d.rstrip("/") for d in glob.glob(self.path + "/*/")]:
+            if d not in self.watched_dirs.values():
+                try:
+                    wd = self.inotify.add_watch(d, flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO)
+                    self.watched_dirs[wd] = d
+                except OSError:
+                    pass
+
+    def wait(self):
+        """Sleep until a file is created or finished in the folder, or at most poll_interval seconds."""
+        if not self.inotify:
+            time.sleep(self.poll_interval)
+            return
+        from inotify_simple import flags
+        for event in self.inotify.read(timeout=self.poll_interval * 1000, read_delay=1000):
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO) and event.wd in self.watched_dirs:
+                self.closed.add(os.path.join(self.watched_dirs[event.wd], event.name))
+
+
+def watch(path, upload_samples, state_file, stable_seconds=STABLE_SECONDS, poll_interval=POLL_INTERVAL,
+          check_uploads=None):
+    """Upload samples from path as they become complete, until the run is complete.
+
+    upload_samples is called with {sample: files} for each batch of newly ready samples and returns
+    {sample: sample id, or None if it failed or was skipped} for the samples it tried. Samples it
+    leaves out (e.g. because their metadata isn't filled in yet) are offered again on the next check.
+    Uploaded samples are saved to state_file so they are skipped after a restart; failed samples are
+    retried after a restart.
+
+    If given, check_uploads is called after every check with final=True once the run is complete,
+    and returns the names of uploaded samples that IDseq could not process.
+    """
+    state = cache.load_json(state_file, {})
+    attempted = set(state)
+    watcher = RunFolderWatcher(path, stable_seconds, poll_interval)
+    print("\nWatching {} for new samples ({}). Press Ctrl-C to stop.".format(
+        path, "inotify" if watcher.inotify else "polling every {}s".format(poll_interval)))
+    if state:
+        print("{} sample(s) were already uploaded by an earlier run.".format(len(state)))
+
+    while True:
+        # Check for the marker before listing, so files written just before it aren't missed
+        run_complete = watcher.is_run_complete()
+        ready, pending = watcher.ready_samples(run_complete)
+        new_samples = dict((s, f) for s, f in ready.items() if s not in attempted)
+        if new_samples:
+            results = upload_samples(new_samples)
+            attempted.update(results)
+            for sample, sample_id in results.items():
+                if sample_id:
+                    state[sample] = {"files": new_samples[sample], "sample_id": sample_id}
+            cache.save_json(state_file, state)
+
+        done = run_complete and not pending
+        if check_uploads:
+            failed = [sample for sample in check_uploads(done) if sample in state]
+            if failed:
+                for sample in failed:
+                    del state[sample]
+                cache.save_json(state_file, state)
+        if done:
+            print("\nRun complete. {} sample(s) uploaded.".format(len(state)))
+            return state
+        watcher.wait()
@@ -0,0 +1,44 @@
+"""Benchmark the startup cost of the idseq entry point.
+
+Runs `import idseq.cli` in fresh interpreters and reports the median time over an empty interpreter.
+Exits non-zero if it exceeds the budget so startup regressions (e.g. an eager heavy import) are caught.
+
+Usage: python scripts/import_time.py [runs] [budget_ms]
+"""
+
+from __future__ import print_function
+import subprocess
+import sys
+import time
+
+DEFAULT_RUNS = 20
+DEFAULT_BUDGET_MS = 50
+
+
+def median_ms(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        timings.append((time.time() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BUDGET_MS
+
+    # Warm up so .pyc compilation isn't counted
+    median_ms("import idseq.cli", 1)
+    baseline = median_ms("pass", runs)
+    total = median_ms("import idseq.cli", runs)
+    import_ms = total - baseline
+    print("import idseq.cli: {:.1f} ms (interpreter startup {:.1f} ms, budget {:.0f} ms)".format(
+        import_ms, baseline, budget_ms))
+    if import_ms > budget_ms:
+        print("ERROR: import time is over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
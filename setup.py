@@ -1,7 +1,12 @@
+import re
 from setuptools import setup
 
+# Read the version without importing the package (and its dependencies)
+with open('idseq/__init__.py') as f:
+    version = re.search(r"__version__ = '(.+)'", f.read()).group(1)
+
 setup(name='idseq',
-      version='0.8.14',
+      version=version,
       description='IDseq CLI',
       url='http://github.com/chanzuckerberg/idseq-cli',
       author='Chan Zuckerberg Initiative, LLC',
@@ -11,4 +16,4 @@ setup(name='idseq',
       zip_safe=False,
       install_requires=['future', 'requests'],
       entry_points={'console_scripts': ['idseq=idseq.cli:main']},
-      extras_require={'dev': ['flake8']})
+      extras_require={'dev': ['flake8'], 'watch': ['inotify_simple']})